@@ -1,9 +1,16 @@
 import requests
 import msal
 import os
-import json
-import pathspec
+import orjson
+import base64
+import mmap
+import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathspec.patterns.gitignore.basic import GitIgnoreBasicPattern
 
 TENANT_ID = os.environ.get("TENANT_ID")
 CLIENT_ID = os.environ.get("CLIENT_ID")
@@ -14,23 +21,135 @@ DRIVE_ID = os.environ.get("DRIVE_ID")
 LOCAL_DIRECTORY_PATH = os.environ.get("LOCAL_DIRECTORY_PATH")
 SHAREPOINT_BASE_FOLDER = os.environ.get("SHAREPOINT_BASE_FOLDER")
 SYNC_DELETIONS = os.environ.get("SYNC_DELETIONS", 'false').lower() == 'true'
+DELTA_STATE_FILE = os.environ.get("DELTA_STATE_FILE")
+TOKEN_CACHE_FILE = os.environ.get("TOKEN_CACHE_FILE")
+# Local file hashes are kept next to the delta state, so both are cached together
+HASH_CACHE_FILE = f"{DELTA_STATE_FILE}.hashes" if DELTA_STATE_FILE else None
+
+MAX_CONCURRENCY = os.environ.get("MAX_CONCURRENCY") or '16'
+if not MAX_CONCURRENCY.strip().isdigit() or int(MAX_CONCURRENCY) < 1:
+    print(f"Invalid max-concurrency '{MAX_CONCURRENCY}'. It must be a whole number of at least 1.")
+    exit(1)
+MAX_UPLOAD_WORKERS = int(MAX_CONCURRENCY)
+MAX_WALK_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+GRAPH_BATCH_SIZE = 20 # Maximum number of sub-requests Graph accepts in one $batch call
+MAX_BATCH_RETRIES = 5
+SIMPLE_UPLOAD_MAX_SIZE = 4 * 1024 * 1024 # Largest file Graph accepts in a single PUT
+# Upload session chunks must be a multiple of 320 KiB; 10 MiB is the size Graph recommends
+UPLOAD_CHUNK_SIZE = 32 * 320 * 1024
+QUICK_XOR_WIDTH = 160 # quickXorHash register width, in bits
+QUICK_XOR_SHIFT = 11
 
 # --- Script Logic ---
 
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps the number of in-flight Graph requests using additive increase and
+    multiplicative decrease: the limit grows by one after a full window of successful
+    requests, up to the hard cap, and halves whenever Graph throttles a request.
+    """
+    def __init__(self, hard_cap):
+        self.hard_cap = hard_cap
+        self.limit = hard_cap
+        self._in_flight = 0
+        self._successes = 0
+        self._epoch = 0 # Bumped on every decrease
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+            self._local.epoch = self._epoch
+            self._local.throttled = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._in_flight -= 1
+            if exc_type is None and not self._local.throttled:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.hard_cap:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def throttled(self):
+        """Records that Graph throttled the request made on the calling thread."""
+        with self._condition:
+            self._local.throttled = True
+            # Requests already in flight when the limit was cut are throttled for the same
+            # reason, so only a request started since the last decrease cuts it again.
+            # At a limit of 1 there is nothing left to cut, so the signal is dropped.
+            if self.limit > 1 and getattr(self._local, 'epoch', self._epoch) == self._epoch:
+                self.limit = max(1, self.limit // 2)
+                self._epoch += 1
+                self._successes = 0
+                print(f"Throttled by Graph API. Reducing concurrency to {self.limit}.")
+            self._local.epoch = self._epoch
+
+class ThrottleAwareRetry(Retry):
+    """A urllib3 Retry that reports throttled (429) responses to the concurrency limiter."""
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and response.status == 429:
+            LIMITER.throttled()
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+LIMITER = AdaptiveConcurrencyLimiter(MAX_UPLOAD_WORKERS)
+
+# A single session keeps TLS connections to Graph warm across every call. The pool
+# covers all upload worker pools so threads never wait on a connection.
+# Throttling (429) and transient server errors are retried by urllib3, honouring
+# Retry-After; once retries run out the last response is returned to the caller.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=max(32, 3 * MAX_UPLOAD_WORKERS),
+    max_retries=ThrottleAwareRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+
+def graph_request(method, url, **kwargs):
+    """Sends a request through the shared, retrying session once the limiter allows it."""
+    with LIMITER:
+        return SESSION.request(method, url, **kwargs)
+
 def get_access_token(tenant_id, client_id, client_secret):
     """
     Authenticates with Azure AD using client credentials flow and returns an access token.
-    MSAL handles token caching automatically.
+    MSAL handles token caching automatically; when TOKEN_CACHE_FILE is set the cache is
+    also kept on disk, so a still valid token from a previous run is reused.
     """
+    cache = msal.SerializableTokenCache()
+    if TOKEN_CACHE_FILE and os.path.exists(TOKEN_CACHE_FILE):
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            cache.deserialize(f.read())
+
     authority = f"https://login.microsoftonline.com/{tenant_id}"
     app = msal.ConfidentialClientApplication(
         client_id=client_id,
         authority=authority,
-        client_credential=client_secret
+        client_credential=client_secret,
+        token_cache=cache
     )
     
     scopes = ["https://graph.microsoft.com/.default"]
     result = app.acquire_token_for_client(scopes=scopes)
+
+    if TOKEN_CACHE_FILE and cache.has_state_changed:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE) or '.', exist_ok=True)
+        # The cache holds a live access token, so keep it readable by the owner only
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600) # The mode above only applies when the file is created
+        with os.fdopen(fd, 'w') as f:
+            f.write(cache.serialize())
         
     if "access_token" in result:
         print("Access token acquired successfully.")
@@ -42,126 +161,492 @@ def get_access_token(tenant_id, client_id, client_secret):
         print(result.get("correlation_id"))
         return None
 
-def get_remote_files_recursive(access_token, site_id, drive_id, item_path=""):
+def quick_xor_hash(file_path):
     """
-    Recursively lists all files in a SharePoint directory and returns a dictionary
-    mapping their relative path to their item ID.
+    Computes the quickXorHash that Graph reports for SharePoint files. Every byte is
+    XORed into a 160-bit register rotated by 11 bits per byte offset, and the file
+    length is XORed into the top 64 bits. Returns the base64 encoded digest.
     """
-    headers = {'Authorization': f'Bearer {access_token}'}
-    # Properly format the root or subfolder path for the API call
-    if not item_path:
-        # If we are at the root of the upload folder
-        api_path = f"root:/{SHAREPOINT_BASE_FOLDER}"
+    # The rotation repeats every 160 bytes, so bytes whose offsets are equal modulo 160
+    # can be folded together with big integer XORs and each column rotated only once.
+    # The block size is a multiple of the row size so columns stay aligned across reads.
+    row_size = QUICK_XOR_WIDTH # bytes
+    columns = 0
+    length = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(row_size * 65536)
+            if not block: break
+            length += len(block)
+            value = int.from_bytes(block, 'little')
+            # Pad to a power-of-two number of rows, then XOR the halves together
+            width = (row_size * 8) << (-(-len(block) // row_size) - 1).bit_length()
+            while width > row_size * 8:
+                width //= 2
+                value = (value & ((1 << width) - 1)) ^ (value >> width)
+            columns ^= value
+
+    mask = (1 << QUICK_XOR_WIDTH) - 1
+    digest = 0
+    for i in range(row_size):
+        byte = (columns >> (8 * i)) & 0xFF
+        rotation = (QUICK_XOR_SHIFT * i) % QUICK_XOR_WIDTH
+        digest ^= ((byte << rotation) | (byte >> (QUICK_XOR_WIDTH - rotation))) & mask
+    digest ^= length << (QUICK_XOR_WIDTH - 64)
+    return base64.b64encode(digest.to_bytes(QUICK_XOR_WIDTH // 8, 'little')).decode()
+
+def is_unchanged(local_file_path, remote_file, hash_cache, cache_key):
+    """
+    Checks whether a local file matches its SharePoint copy by size and quickXorHash.
+    Local hashes are kept in hash_cache under cache_key along with the file's size and
+    modification time, so a file that hasn't been touched isn't hashed again.
+    """
+    stat = os.stat(local_file_path)
+    if remote_file.get('size') != stat.st_size or not remote_file.get('quickXorHash'):
+        return False
+    cached = hash_cache.get(cache_key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        local_hash = cached[2]
     else:
-        # If we are in a subfolder
-        api_path = f"root:/{SHAREPOINT_BASE_FOLDER}/{item_path}"
-    
-    # URL encode the path to handle special characters
-    encoded_api_path = requests.utils.quote(api_path)
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/{encoded_api_path}:/children"
-    
-    remote_files = {}
-    try:
-        response = requests.get(url, headers=headers)
+        local_hash = quick_xor_hash(local_file_path)
+        hash_cache[cache_key] = [stat.st_size, stat.st_mtime_ns, local_hash]
+    return remote_file['quickXorHash'] == local_hash
+
+def load_state_file(state_path):
+    """Loads state saved by a previous run, such as the drive snapshot, if any."""
+    if not state_path or not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def save_state_file(state_path, state):
+    """Persists state, such as the drive snapshot, for the next run."""
+    if not state_path:
+        return
+    os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+    with open(state_path, 'wb') as f:
+        f.write(orjson.dumps(state))
+
+def list_remote_folder(access_token, url, relative_dir):
+    """
+    Lists one SharePoint folder, following pagination, and returns its files as
+    (relative path, file info) pairs along with the subfolders to visit.
+    """
+    headers = {'Authorization': f'Bearer {access_token}'}
+    files, subfolders = [], []
+    while url:
+        response = graph_request('GET', url, headers=headers)
         response.raise_for_status() # Raise an exception for bad status codes
-        items = response.json().get('value', [])
-        
-        for item in items:
-            current_path = os.path.join(item_path, item['name']).replace(os.path.sep, '/')
+        page = orjson.loads(response.content)
+        for item in page.get('value', []):
+            current_path = relative_dir + item['name']
             if 'file' in item:
-                remote_files[current_path] = item['id']
+                files.append((current_path, {
+                    'id': item['id'],
+                    'size': item.get('size'),
+                    'quickXorHash': item['file'].get('hashes', {}).get('quickXorHash'),
+                }))
             elif 'folder' in item:
-                # Give Graph API a moment before the next recursive call
-                time.sleep(0.1) 
-                remote_files.update(get_remote_files_recursive(access_token, site_id, drive_id, current_path))
-                
+                subfolders.append((current_path + '/', item['id']))
+        url = page.get('@odata.nextLink')
+    return files, subfolders
+
+def get_remote_files_children(access_token, site_id, drive_id):
+    """
+    Lists all files in the SharePoint base folder by walking its children and returns
+    a dictionary mapping their relative path to their item ID, size and quickXorHash.
+    """
+    drive_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}"
+    select = "?$select=id,name,size,file,folder"
+    # URL encode the path to handle special characters
+    base_url = f"{drive_url}/{requests.utils.quote(f'root:/{SHAREPOINT_BASE_FOLDER}')}:/children{select}"
+
+    # Folders are listed in parallel, the same way the local directory is walked
+    remote_files = {}
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            pending = {executor.submit(list_remote_folder, access_token, base_url, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subfolders = future.result()
+                    remote_files.update(files)
+                    for relative_dir, item_id in subfolders:
+                        folder_url = f"{drive_url}/items/{item_id}/children{select}"
+                        pending.add(executor.submit(list_remote_folder, access_token, folder_url, relative_dir))
     except requests.exceptions.HTTPError as e:
         # If the base folder doesn't exist, it's not an error; it just means there are no files to list.
         if e.response.status_code == 404:
             print(f"SharePoint folder '{SHAREPOINT_BASE_FOLDER}' not found. No remote files to compare.")
             return {}
         else:
-            print(f"Error listing remote files at '{item_path}': {e}")
+            print(f"Error listing remote files: {e}")
             print(f"Response: {e.response.text}")
             exit(1) # Exit on other HTTP errors
-            
+
     return remote_files
 
-def delete_sharepoint_item(access_token, site_id, drive_id, item_id):
-    """Deletes an item (file or folder) from SharePoint by its ID."""
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/items/{item_id}"
+def get_remote_files_delta(access_token, site_id, drive_id):
+    """
+    Lists all files in the SharePoint base folder using the drive's delta feed and
+    returns a dictionary mapping their relative path to their item ID, size and
+    quickXorHash. The snapshot of the drive is kept in DELTA_STATE_FILE between runs
+    so only the changes since the previous run have to be fetched.
+    """
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.delete(url, headers=headers)
-    if response.status_code == 204:
-        print(f"Successfully deleted item {item_id}")
-    else:
-        print(f"Error deleting item {item_id}: {response.status_code} - {response.text}")
+    # Delta is only supported on the drive root for SharePoint, so we follow the whole
+    # drive and narrow it down to the base folder once paths are resolved.
+    full_sync_url = (f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root/delta"
+                     "?$select=id,name,parentReference,file,folder,root,deleted,size")
+
+    state = load_state_file(DELTA_STATE_FILE)
+    items = state.get('items', {})
+    url = state.get('deltaLink') or full_sync_url
+    delta_link = None
+
+    while url:
+        response = graph_request('GET', url, headers=headers)
+        if response.status_code == 410:
+            # The saved delta link has expired; start again with a full enumeration
+            print("Saved delta link has expired. Re-reading the whole drive.")
+            items = {}
+            url = full_sync_url
+            continue
+        try:
+            response.raise_for_status() # Raise an exception for bad status codes
+        except requests.exceptions.HTTPError as e:
+            print(f"Error listing remote files: {e}")
+            print(f"Response: {e.response.text}")
+            exit(1) # Exit on HTTP errors
+
+        page = orjson.loads(response.content)
+        for item in page.get('value', []):
+            if 'deleted' in item:
+                items.pop(item['id'], None)
+                continue
+            items[item['id']] = {
+                'name': item.get('name'),
+                'parent': item.get('parentReference', {}).get('id'),
+                'is_root': 'root' in item,
+                'is_file': 'file' in item,
+                'size': item.get('size'),
+                'quickXorHash': item.get('file', {}).get('hashes', {}).get('quickXorHash'),
+            }
+        url = page.get('@odata.nextLink')
+        delta_link = page.get('@odata.deltaLink', delta_link)
 
-def upload_file_to_sharepoint(access_token, site_id, drive_id, local_file_path, sharepoint_file_path):
-    """Uploads a single file to SharePoint using a resumable upload session."""
-    # ... (This function remains the same as before)
-    upload_session_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root:/{sharepoint_file_path}:/createUploadSession"
+    save_state_file(DELTA_STATE_FILE, {'deltaLink': delta_link, 'items': items})
+
+    # Delta items on SharePoint don't carry a parent path, so rebuild each path from
+    # the chain of parent IDs. Items whose parents are gone resolve to None.
+    paths = {}
+    def resolve_path(item_id):
+        if item_id not in paths:
+            item = items.get(item_id)
+            if item is None:
+                paths[item_id] = None
+            elif item['is_root']:
+                paths[item_id] = ''
+            else:
+                parent_path = resolve_path(item['parent'])
+                paths[item_id] = None if parent_path is None else f"{parent_path}/{item['name']}".lstrip('/')
+        return paths[item_id]
+
+    base_folder = SHAREPOINT_BASE_FOLDER.strip('/').lower()
+    prefix = base_folder + '/'
+    remote_files = {}
+    base_folder_found = False
+    for item_id, item in items.items():
+        path = resolve_path(item_id)
+        if path is None:
+            continue
+        # SharePoint paths are case-insensitive
+        if path.lower() == base_folder:
+            base_folder_found = True
+        elif item['is_file'] and path.lower().startswith(prefix):
+            remote_files[path[len(prefix):]] = {
+                'id': item_id,
+                'size': item.get('size'),
+                'quickXorHash': item.get('quickXorHash'),
+            }
+
+    # If the base folder doesn't exist, it's not an error; it just means there are no files to list.
+    if not base_folder_found:
+        print(f"SharePoint folder '{SHAREPOINT_BASE_FOLDER}' not found. No remote files to compare.")
+        return {}
+
+    return remote_files
+
+def delete_sharepoint_items(access_token, site_id, drive_id, item_ids):
+    """
+    Deletes items (files or folders) from SharePoint by their IDs, sending them to the
+    Graph $batch endpoint in groups of 20. Sub-requests that are throttled are retried
+    after the Retry-After interval Graph asks for.
+    """
+    url = "https://graph.microsoft.com/v1.0/$batch"
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+    for chunk_start in range(0, len(item_ids), GRAPH_BATCH_SIZE):
+        pending = item_ids[chunk_start:chunk_start + GRAPH_BATCH_SIZE]
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            batch_payload = {"requests": [
+                {"id": str(i), "method": "DELETE", "url": f"/sites/{site_id}/drives/{drive_id}/items/{item_id}"}
+                for i, item_id in enumerate(pending)
+            ]}
+            response = graph_request('POST', url, headers=headers, data=orjson.dumps(batch_payload))
+            if response.status_code != 200:
+                print(f"Error deleting items {', '.join(pending)}: {response.status_code} - {response.text}")
+                break
+
+            throttled = []
+            retry_after = 0
+            for sub_response in orjson.loads(response.content).get('responses', []):
+                item_id = pending[int(sub_response['id'])]
+                status = sub_response['status']
+                if status == 204:
+                    print(f"Successfully deleted item {item_id}")
+                elif status == 429 and attempt < MAX_BATCH_RETRIES:
+                    throttled.append(item_id)
+                    retry_after = max(retry_after, int(sub_response.get('headers', {}).get('Retry-After', 1)))
+                else:
+                    print(f"Error deleting item {item_id}: {status} - {sub_response.get('body')}")
+
+            if not throttled:
+                break
+            # The whole batch is one request, so it counts as a single throttling signal
+            LIMITER.throttled()
+            print(f"Throttled while deleting {len(throttled)} items. Retrying in {retry_after}s...")
+            time.sleep(retry_after)
+            pending = throttled
+
+def get_item_url(site_id, drive_id, sharepoint_file_path):
+    """Returns the Graph URL addressing a drive item by its SharePoint path."""
+    # URL encode the path to handle special characters
+    return f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root:/{requests.utils.quote(sharepoint_file_path)}:"
+
+def upload_small_file(access_token, site_id, drive_id, local_file_path, sharepoint_file_path):
+    """Uploads a file of up to 4 MiB to SharePoint in a single PUT."""
+    # The body is sent uncompressed: Graph doesn't document decoding a request
+    # Content-Encoding, and the stored bytes must match the local quickXorHash.
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/octet-stream'}
+    with open(local_file_path, 'rb') as f:
+        data = f.read()
+    upload_url = f"{get_item_url(site_id, drive_id, sharepoint_file_path)}/content?@microsoft.graph.conflictBehavior=replace"
+    upload_response = graph_request('PUT', upload_url, headers=headers, data=data)
+    if upload_response.status_code not in (200, 201):
+        print(f"Error uploading {sharepoint_file_path}: {upload_response.status_code} - {upload_response.text}")
+        return
+    print(f"Successfully uploaded: {sharepoint_file_path}")
+
+def create_upload_session(access_token, site_id, drive_id, sharepoint_file_path):
+    """Creates a resumable upload session for a file and returns its upload URL."""
+    upload_session_url = f"{get_item_url(site_id, drive_id, sharepoint_file_path)}/createUploadSession"
     headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
     session_payload = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
-    session_response = requests.post(upload_session_url, headers=headers, data=json.dumps(session_payload))
+    session_response = graph_request('POST', upload_session_url, headers=headers, data=orjson.dumps(session_payload))
     if session_response.status_code != 200:
         print(f"Error creating upload session for {sharepoint_file_path}: {session_response.status_code} - {session_response.json()}")
-        return
-    upload_url = session_response.json().get('uploadUrl')
-    file_size = os.path.getsize(local_file_path)
-    chunk_size = 4 * 1024 * 1024
-    with open(local_file_path, 'rb') as f:
-        start_index = 0
-        while True:
-            chunk = f.read(chunk_size)
-            if not chunk: break
-            end_index = start_index + len(chunk) - 1
-            chunk_headers = {'Content-Length': str(len(chunk)), 'Content-Range': f'bytes {start_index}-{end_index}/{file_size}'}
-            upload_response = requests.put(upload_url, headers=chunk_headers, data=chunk)
+        return None
+    return orjson.loads(session_response.content).get('uploadUrl')
+
+def upload_chunks(upload_url, local_file_path, sharepoint_file_path, file_size):
+    """Uploads a file's content to an upload session, one chunk at a time."""
+    # Every chunk but the last has the same length, so build the header strings once and
+    # update a single dict per chunk; requests copies headers when it prepares a request.
+    file_size_str = str(file_size)
+    full_chunk_length = str(UPLOAD_CHUNK_SIZE)
+    chunk_headers = {'Content-Length': full_chunk_length, 'Content-Range': ''}
+    # Graph only accepts the chunks of an upload session in order, so they are sent sequentially.
+    # Chunks are zero-copy slices of a memory map rather than freshly read bytes objects;
+    # each slice is released after its PUT so the map can be closed.
+    with open(local_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start_index in range(0, file_size, UPLOAD_CHUNK_SIZE):
+            end_index = start_index + UPLOAD_CHUNK_SIZE - 1
+            if end_index >= file_size:
+                end_index = file_size - 1
+                chunk_headers['Content-Length'] = str(file_size - start_index)
+            chunk_headers['Content-Range'] = f'bytes {start_index}-{end_index}/{file_size_str}'
+            with memoryview(mm)[start_index:end_index + 1] as chunk:
+                upload_response = graph_request('PUT', upload_url, headers=chunk_headers, data=chunk)
             if not (200 <= upload_response.status_code <= 204):
                 print(f"Error uploading chunk for {sharepoint_file_path}: {upload_response.status_code} - {upload_response.json()}")
                 return
-            start_index = end_index + 1
     print(f"Successfully uploaded: {sharepoint_file_path}")
 
+def upload_files(access_token, site_id, drive_id, upload_pairs):
+    """
+    Uploads (local path, SharePoint path) pairs concurrently. Small files are sent in
+    a single PUT; larger ones go through a resumable upload session. Every upload is
+    attempted; errors raised by workers are reported and the first one is re-raised
+    once all uploads have finished.
+    """
+    # Uploads are network-bound, so overlap them across bounded pools of workers. Small
+    # files have their own pool so they never hold up large ones. Upload sessions are
+    # created on another pool and each file's chunks are queued as soon as its session
+    # is ready, so session creation overlaps with chunk transfers. At most
+    # a window of large files is in progress at once, so sessions are never created far
+    # ahead of the chunk uploads that use them.
+    window = 2 * MAX_UPLOAD_WORKERS
+    failures = []
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as small_executor, \
+         ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as session_executor, \
+         ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as chunk_executor:
+        small_futures = {}
+        large_files = []
+        for local_path, sharepoint_path in upload_pairs:
+            file_size = os.path.getsize(local_path)
+            if file_size <= SIMPLE_UPLOAD_MAX_SIZE:
+                future = small_executor.submit(upload_small_file, access_token, site_id, drive_id, local_path, sharepoint_path)
+                small_futures[future] = sharepoint_path
+            else:
+                large_files.append((local_path, sharepoint_path, file_size))
+
+        large_files = iter(large_files)
+        session_futures = {} # Future -> (local path, SharePoint path, size)
+        chunk_futures = {} # Future -> SharePoint path
+        while True:
+            while len(session_futures) + len(chunk_futures) < window:
+                large_file = next(large_files, None)
+                if large_file is None:
+                    break
+                future = session_executor.submit(create_upload_session, access_token, site_id, drive_id, large_file[1])
+                session_futures[future] = large_file
+            if not session_futures and not chunk_futures:
+                break
+
+            done, _ = wait(set(session_futures) | set(chunk_futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in session_futures:
+                    large_file = session_futures.pop(future)
+                    if future.exception():
+                        failures.append((large_file[1], future.exception()))
+                    elif future.result():
+                        chunk_future = chunk_executor.submit(upload_chunks, future.result(), *large_file)
+                        chunk_futures[chunk_future] = large_file[1]
+                else:
+                    sharepoint_path = chunk_futures.pop(future)
+                    if future.exception():
+                        failures.append((sharepoint_path, future.exception()))
+
+    for future, sharepoint_path in small_futures.items():
+        if future.exception():
+            failures.append((sharepoint_path, future.exception()))
+
+    # Surface exceptions raised inside workers
+    for sharepoint_path, error in failures:
+        print(f"Error uploading {sharepoint_path}: {error}")
+    if failures:
+        raise failures[0][1]
+
+def compile_gitignore(lines):
+    """
+    Compiles .gitignore lines into a function that tells whether a relative path is
+    ignored, following git's rules as implemented by pathspec's GitIgnoreBasicPattern.
+    """
+    # Consecutive patterns of the same kind (ignore or negated) are joined into a single
+    # regex, so a path is tested against a handful of regexes instead of every pattern.
+    groups = []
+    for line in lines:
+        regex, include = GitIgnoreBasicPattern.pattern_to_regex(line)
+        if include is None:
+            continue # Blank line or comment
+        if groups and groups[-1][1] == include:
+            groups[-1][0].append(regex)
+        else:
+            groups.append(([regex], include))
+    compiled = [(re.compile('|'.join(f'(?:{r})' for r in regexes)), include) for regexes, include in reversed(groups)]
+
+    def is_ignored(path):
+        # The last matching pattern wins, so check the groups from last to first
+        for regex, include in compiled:
+            if regex.match(path):
+                return include
+        return False
+    return is_ignored
+
+def scan_local_directory(relative_dir, absolute_dir, is_ignored):
+    """
+    Lists one local directory and returns (relative path, local path) pairs for the
+    files in it that are not excluded by .gitignore, along with the subdirectories to visit.
+    """
+    files, subdirs = [], []
+    try:
+        entries = list(os.scandir(absolute_dir))
+    except OSError:
+        return files, subdirs # Unreadable directories are skipped, as os.walk does
+    for entry in entries:
+        relative_path = relative_dir + entry.name
+        if entry.is_dir():
+            # Like os.walk, don't descend into symlinked directories
+            if entry.name == '.git' or entry.is_symlink():
+                continue
+            if not is_ignored or not is_ignored(relative_path):
+                subdirs.append((relative_path + '/', entry.path))
+        elif not is_ignored or not is_ignored(relative_path):
+            files.append((relative_path, entry.path))
+    return files, subdirs
+
+def get_local_files(base_path, is_ignored):
+    """
+    Walks the local directory and returns a dictionary mapping the paths of files not
+    excluded by .gitignore, relative to it and using forward slashes, to their local paths.
+    """
+    # Each directory is scanned by a worker so readdir latency overlaps on deep trees and
+    # network filesystems. Results are collected here, so no locking is needed.
+    # Relative paths are carried along with each directory, so they're never recomputed.
+    local_files = {}
+    with ThreadPoolExecutor(max_workers=MAX_WALK_WORKERS) as executor:
+        pending = {executor.submit(scan_local_directory, '', base_path, is_ignored)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                local_files.update(files)
+                for relative_dir, absolute_dir in subdirs:
+                    pending.add(executor.submit(scan_local_directory, relative_dir, absolute_dir, is_ignored))
+    return local_files
+
 # --- Main Execution Block ---
 if __name__ == "__main__":
     # --- 1. Get Local File List ---
     print("Gathering local file list...")
     gitignore_path = os.path.join(LOCAL_DIRECTORY_PATH, '.gitignore')
-    spec = None
+    is_ignored = None
     if os.path.exists(gitignore_path):
         with open(gitignore_path, 'r') as f:
-            spec = pathspec.PathSpec.from_lines('gitwildmatch', f)
+            is_ignored = compile_gitignore(f)
             
-    local_files = set()
-    for root, dirs, files in os.walk(LOCAL_DIRECTORY_PATH, topdown=True):
-        if '.git' in dirs: dirs.remove('.git')
-        if spec:
-            dirs[:] = [d for d in dirs if not spec.match_file(os.path.join(os.path.relpath(root, LOCAL_DIRECTORY_PATH), d))]
-        for filename in files:
-            local_path = os.path.join(root, filename)
-            relative_path = os.path.relpath(local_path, LOCAL_DIRECTORY_PATH)
-            if not spec or not spec.match_file(relative_path):
-                local_files.add(relative_path.replace(os.path.sep, '/'))
+    local_files = get_local_files(LOCAL_DIRECTORY_PATH, is_ignored)
+    # The action's own state files may sit inside the directory being synced, and the
+    # token cache holds a live access token, so never upload them.
+    state_files = {os.path.realpath(path) for path in (TOKEN_CACHE_FILE, DELTA_STATE_FILE, HASH_CACHE_FILE) if path}
+    local_files = {relative_path: local_path for relative_path, local_path in local_files.items()
+                   if os.path.realpath(local_path) not in state_files}
 
     # --- 2. Authenticate and Handle Deletions (if enabled) ---
     print("Authenticating with Microsoft Graph...")
     token = get_access_token(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
-    
+
+    print("\nListing remote files...")
+    # The delta feed covers the whole drive, which only pays off once its snapshot is
+    # kept between runs; otherwise just the base folder is listed.
+    if DELTA_STATE_FILE:
+        remote_files_map = get_remote_files_delta(token, SITE_ID, DRIVE_ID)
+    else:
+        remote_files_map = get_remote_files_children(token, SITE_ID, DRIVE_ID)
+
     if SYNC_DELETIONS:
         print("\nSync deletions enabled. Comparing remote files with local files...")
-        remote_files_map = get_remote_files_recursive(token, SITE_ID, DRIVE_ID)
         remote_files_set = set(remote_files_map.keys())
         
-        files_to_delete = remote_files_set - local_files
+        files_to_delete = remote_files_set - local_files.keys()
         
         if files_to_delete:
             print(f"\nFound {len(files_to_delete)} files to delete from SharePoint:")
+            item_ids = []
             for file_path in sorted(list(files_to_delete)):
                 print(f" - Deleting: {file_path}")
-                item_id = remote_files_map[file_path]
-                delete_sharepoint_item(token, SITE_ID, DRIVE_ID, item_id)
+                item_ids.append(remote_files_map[file_path]['id'])
+            delete_sharepoint_items(token, SITE_ID, DRIVE_ID, item_ids)
         else:
             print("SharePoint directory is already in sync. No files to delete.")
     else:
@@ -169,9 +654,21 @@ if __name__ == "__main__":
 
     # --- 3. Upload Files ---
     print("\nStarting file uploads...")
-    for relative_path in sorted(list(local_files)):
-        local_path = os.path.join(LOCAL_DIRECTORY_PATH, relative_path)
-        sharepoint_path = os.path.join(SHAREPOINT_BASE_FOLDER, relative_path).replace(os.path.sep, '/')
-        upload_file_to_sharepoint(token, SITE_ID, DRIVE_ID, local_path, sharepoint_path)
+    upload_pairs = []
+    unchanged_count = 0
+    hash_cache = load_state_file(HASH_CACHE_FILE)
+    # Relative paths already use forward slashes, so SharePoint paths only need the prefix
+    sharepoint_prefix = SHAREPOINT_BASE_FOLDER.rstrip('/') + '/'
+    for relative_path, local_path in sorted(local_files.items()):
+        # Skip files whose content is already identical in SharePoint
+        remote_file = remote_files_map.get(relative_path)
+        if remote_file and is_unchanged(local_path, remote_file, hash_cache, relative_path):
+            unchanged_count += 1
+            continue
+        upload_pairs.append((local_path, sharepoint_prefix + relative_path))
+    print(f"{unchanged_count} files are unchanged in SharePoint. Uploading {len(upload_pairs)} files.")
+    save_state_file(HASH_CACHE_FILE, {path: entry for path, entry in hash_cache.items() if path in local_files})
+
+    upload_files(token, SITE_ID, DRIVE_ID, upload_pairs)
         
     print("\nProcess finished.")
\ No newline at end of file